@@ -0,0 +1,77 @@
+"""
+Compiles the add-on's Numba kernels ahead of time into the vox_kernels extension module.
+
+Blender doesn't bundle Numba, and compiling the kernels on first import stalls the add-on for several seconds.
+Run this with Numba installed and the same Python version as the target Blender:
+
+    python build_kernels.py [output directory]
+
+then copy the vox_kernels extension it writes (.so or .pyd) next to io_scene_vox.py in Blender's add-on folder.
+The add-on loads it when present and built from its current kernels, and otherwise falls back to Numba's JIT or
+plain NumPy.
+
+Needs a Numba release that still ships numba.pycc, 0.68 is known to work. Numba has marked pycc as pending
+deprecation and warns about it on import, so a future release may remove it.
+
+Extensions are named after the Python version and platform they were built for, so builds from several
+machines can be shipped side by side and each Blender imports the one matching it.
+"""
+import ast
+import hashlib
+import os
+import sys
+
+import numpy as np
+
+try:
+    from numba.pycc import CC
+except ImportError as exc:  # pycc is pending deprecation in Numba, later releases may drop it.
+    sys.exit(f"build_kernels.py needs numba.pycc, which can't be imported ({exc}). "
+             "Install a Numba release that still ships it, 0.68 is known to work.")
+
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "io_scene_vox.py")
+
+
+def load_kernels(path):
+    """
+    Pulls the kernel functions and their signature out of the add-on without importing it, as that needs bpy.
+    :param path: path of io_scene_vox.py
+    :return: {name: function or value} of the kernel functions, signature constants and kernel_version
+    """
+    with open(path) as file:
+        tree = ast.parse(file.read())
+
+    wanted = []
+    for node in tree.body:
+        if isinstance(node, ast.FunctionDef) and (node.name.endswith("_kernel") or node.name == "kernel_version"):
+            wanted.append(node)
+        elif isinstance(node, ast.Assign) and any(target.id.endswith("_SIGNATURE") for target in node.targets
+                                                  if isinstance(target, ast.Name)):
+            wanted.append(node)
+
+    namespace = {"np": np, "ast": ast, "hashlib": hashlib}
+    exec(compile(ast.Module(body=wanted, type_ignores=[]), path, "exec"), namespace)
+    return namespace
+
+
+def main(output_dir):
+    kernels = load_kernels(SOURCE)
+    with open(SOURCE, encoding="utf-8") as file:
+        version = kernels["kernel_version"](file.read())
+
+    cc = CC("vox_kernels")
+    cc.output_dir = output_dir
+    cc.export("emit_faces", kernels["EMIT_FACES_SIGNATURE"])(kernels["_emit_faces_kernel"])
+
+    # Lets the add-on tell this build from one of other kernels, Numba freezes the value into the function.
+    def kernel_version():
+        return version
+
+    cc.export("kernel_version", "int64()")(kernel_version)
+    cc.compile()
+
+    print(os.path.join(output_dir, cc.output_file))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1] if len(sys.argv) > 1 else os.path.dirname(SOURCE))
@@ -1,15 +1,25 @@
-import copy
+import ast
+import collections
+import hashlib
 import math
+import mmap
 import os
 
 import bpy
-import bmesh
+import numpy as np
 from bpy_extras.io_utils import ImportHelper
 from bpy.props import StringProperty, IntProperty, FloatProperty, BoolProperty, CollectionProperty, EnumProperty
 from bpy.types import Operator
+from mathutils import Matrix
 
 import struct
 
+try:
+    from numba import njit
+    HAS_NUMBA = True
+except ImportError:  # Numba is optional, Blender doesn't bundle it.
+    HAS_NUMBA = False
+
 bl_info = {
     "name": "MagicaVoxel VOX Importer",
     "author": "brujo.3d, RichysHub",
@@ -61,12 +71,22 @@ class ImportVox(Operator, ImportHelper):
     gamma_value: FloatProperty(name="Gamma Correction Value",
                                default=2.2, min=0)
 
-    override_materials: BoolProperty(name="Override Existing Materials", default=True)
+    override_materials: BoolProperty(name="Override Existing Materials",
+                                     description="Recreate materials that already exist. Texture materials still in use are recreated under a new name, and ones reused by Share Materials are left as they are.",
+                                     default=True)
+
+    share_materials: BoolProperty(name="Share Materials",
+                                  description="Reuse the material and textures of an earlier import with the same palette, as they are, even with Override Existing Materials on.",
+                                  default=True)
 
     cleanup_mesh: BoolProperty(name="Cleanup Mesh",
-                               description="Merge overlapping verticies and recalculate normals.",
+                               description="Merge the vertices shared by neighbouring colors.",
                                default=True)
 
+    merge_models: BoolProperty(name="Merge Models",
+                               description="Join every model of the scene into a single object.",
+                               default=False)
+
     create_lights: BoolProperty(name="Add Point Lights",
                                 description="Add point lights at emissive voxels for Eevee.",
                                 default=False)
@@ -106,8 +126,11 @@ class ImportVox(Operator, ImportHelper):
                 layout.prop(self, "gamma_value")
         if self.material_type != 'None':
             layout.prop(self, "override_materials")
+        if self.material_type == 'Tex':
+            layout.prop(self, "share_materials")
 
         layout.prop(self, "cleanup_mesh")
+        layout.prop(self, "merge_models")
         layout.prop(self, "create_lights")
         # layout.prop(self, "create_volume")
         layout.prop(self, "organize")
@@ -116,61 +139,66 @@ class ImportVox(Operator, ImportHelper):
 ################################################################################################################################################
 ################################################################################################################################################
 
-class Vec3:
-    def __init__(self, X, Y, Z):
-        self.x, self.y, self.z = X, Y, Z
-
-    def __str__(self):
-        return f"Vec3{self.as_tup()}"
-
-    def __repr__(self):
-        return str(self)
-
-    def as_tup(self):
-        return self.x, self.y, self.z
-
-    def _index(self):
-        return self.x + self.y * 256 + self.z * 256 * 256
+Vec3 = collections.namedtuple('Vec3', 'x y z')
 
 
 class VoxelObject:
     def __init__(self, Voxels, Size):
+        """
+        :param Voxels: uint8 ndarray of shape (N, 4), one (x, y, z, color id) row per voxel
+        :param Size: Vec3 model dimensions
+        """
         self.size = Size
-        self.voxels = {}
-        self.used_colors = []
-        self.position = Vec3(0, 0, 0)
-        self.rotation = Vec3(0, 0, 0)
 
-        for vox in Voxels:
-            #              x       y       z
-            pos = Vec3(vox[0], vox[1], vox[2])
-            self.voxels[pos._index()] = (pos, vox[3])
+        # Color id per voxel, padded by one empty voxel on every side so neighbour lookups never go out of bounds.
+        self.grid = np.zeros((Size.x + 2, Size.y + 2, Size.z + 2), dtype=np.uint8)
 
-            if vox[3] not in self.used_colors:
-                self.used_colors.append(vox[3])
+        # Widened before the padding offset, a coordinate of 255 would wrap to 0 in uint8.
+        x, y, z = Voxels[:, :3].astype(np.intp).T + 1
+        self.grid[x, y, z] = Voxels[:, 3]
 
-    def getVox(self, pos):
-        key = pos._index()
-        if key in self.voxels:
-            return self.voxels[key][1]
+        # Unique over the N voxel rows rather than the whole grid, 0 marks empty.
+        used_colors = np.unique(Voxels[:, 3])
+        self.used_colors = used_colors[used_colors != 0].tolist()
 
-        return 0
+        # Shifts the mesh so the object origin sits where MagicaVoxel puts it.
+        self.offset = np.array([int(-Size.x / 2), int(-Size.y / 2), int(-Size.z / 2)], dtype=np.float32)
 
-    def compareVox(self, colA, b):
-        colB = self.getVox(b)
-
-        if colB == 0:
-            return False
-        return True
+        self._mesh_data = {}  # {weld: mesh_data() result}
+        self._light_positions = None  # light_positions() result
 
     def addLight(self, name, pos, light):
         return None
         # return light_obj
 
-    def generate(self, file_name, vox_size, material_type, palette, materials, cleanup, collections):
-        objects = []
-        lights = []
-
+    def mesh_data(self, weld):
+        """
+        Meshes the model, instances share the model so later calls reuse the result.
+        :param weld: share vertices between colors
+        :return: verts (V, 3) float32 ndarray around the MagicaVoxel origin, faces (F, 4) int32 ndarray,
+                 face_colors (F,) int32 ndarray of color ids
+        """
+        if weld not in self._mesh_data:
+            verts, faces, face_colors = greedy_mesh(self.grid, weld=weld)  # Meshes every color in one pass.
+            self._mesh_data[weld] = (verts.astype(np.float32) + self.offset, faces, face_colors)
+
+        return self._mesh_data[weld]
+
+    def light_positions(self, materials):
+        """
+        Finds where lights go, instances share the model so later calls reuse the result.
+        :param materials: [[roughness, metallic, glass, emission, specular, flux], ...] per color id - 1,
+                          the same for every call as a model belongs to a single import
+        :return: {color id: (N, 3) ndarray of exposed voxel centers around the MagicaVoxel origin} for emissive colors
+        """
+        if self._light_positions is None:
+            self._light_positions = {Col: surface_voxels(self.grid, Col) + 0.5 + self.offset
+                                     for Col in self.used_colors if materials[Col - 1][3] > 0}
+
+        return self._light_positions
+
+    def generate(self, file_name, matrix, vox_size, material_type, palette_lut, material_lut, materials,
+                 model_materials, cleanup, collections):
         self.materials = materials  # For helper functions.
 
         mesh_col, light_col, volume_col = collections
@@ -178,459 +206,880 @@ class VoxelObject:
         if len(self.used_colors) == 0:  # Empty Object
             return
 
-        for Col in self.used_colors:  # Create an object for each color and then join them.
+        verts, faces, face_colors = self.mesh_data(cleanup)
+        obj = create_voxel_object(file_name, verts, faces, face_colors, material_type, palette_lut, material_lut,
+                                  model_materials, mesh_col)
 
-            mesh = bpy.data.meshes.new(file_name)  # Create mesh
-            obj = bpy.data.objects.new(file_name, mesh)  # Create object
+        # Lights
+        if light_col != None:
+            add_lights(file_name, obj, self.light_positions(materials), vox_size, palette_lut, materials, light_col)
 
-            # Create light data
-            if light_col != None and materials[Col - 1][3] > 0:
-                light_data = bpy.data.lights.new(name=file_name + "_" + str(Col), type="POINT")
-                light_data.color = palette[Col - 1][:3]
-                light_data.energy = materials[Col - 1][3] * 500 * vox_size
-                light_data.specular_factor = 0  # Don't want circular reflections.
-                light_data.shadow_soft_size = vox_size / 2
-                light_data.shadow_buffer_clip_start = vox_size
+        # Set scale, rotation and position, scaling the voxel space transform to blender units.
+        world = matrix * vox_size
+        world[3] = matrix[3]
+        obj.matrix_world = Matrix(world.tolist())
 
-            # Link Object to Scene
-            if mesh_col == None:
-                bpy.context.scene.collection.objects.link(obj)
-            else:
-                mesh_col.objects.link(obj)
 
-            objects.append(obj)  # Keeps track of created objects for joining.
+class ModelInstance:
+    """
+    Placement of a shared, read-only VoxelObject in the scene.
+    """
+    __slots__ = ('model', 'matrix')
 
-            verts = []
-            faces = []
+    def __init__(self, model, matrix):
+        self.model = model
+        self.matrix = matrix  # 4x4 float32 ndarray, voxel space to scene voxel space
 
-            for key in self.voxels:
-                pos, colID = self.voxels[key]
-                x, y, z = pos.x, pos.y, pos.z
 
-                if colID != Col:
-                    continue
+def create_voxel_object(name, verts, faces, face_colors, material_type, palette_lut, material_lut, model_materials,
+                        mesh_col):
+    """
+    Creates and links one mesh object, with its materials, vertex colors or UVs.
+    :param verts: (V, 3) float32 ndarray
+    :param faces: (F, 4) int32 ndarray
+    :param face_colors: (F,) int32 ndarray of color ids
+    :return: bpy.types.Object
+    """
+    mesh = bpy.data.meshes.new(name)  # Create mesh
+    obj = bpy.data.objects.new(name, mesh)  # Create object
+
+    # Link Object to Scene
+    if mesh_col == None:
+        bpy.context.scene.collection.objects.link(obj)
+    else:
+        mesh_col.objects.link(obj)
+
+    fill_mesh(mesh, verts, faces)
+
+    loop_colors = np.repeat(face_colors, 4)
+
+    if material_type == 'SepMat' or material_type == 'Recolor':
+        # One slot per color, in color id order.
+        slot_colors = np.unique(face_colors)
+        for Col in slot_colors.tolist():
+            mesh.materials.append(model_materials[Col])
+
+        slots = np.searchsorted(slot_colors, face_colors).astype(np.int32)
+        mesh.polygons.foreach_set("material_index", slots)
+
+    elif material_type == 'VertCol':
+        mesh.materials.append(model_materials[1])
+
+        # Create Vertex Colors
+        color_layer = mesh.vertex_colors.new(name="Col")
+        material_layer = mesh.vertex_colors.new(name="Mat")
+
+        # Set Vertex Colors
+        color_layer.data.foreach_set("color", palette_lut[loop_colors - 1].ravel())
+        material_layer.data.foreach_set("color", material_lut[loop_colors - 1].ravel())
+
+    elif material_type == 'Tex':
+        mesh.materials.append(model_materials[1])
+
+        # Create UVs
+        uv = mesh.uv_layers.new(name="UVMap")
+        uvs = np.full((len(loop_colors), 2), 0.5, dtype=np.float32)
+        uvs[:, 0] = (loop_colors - 0.5) / 256
+        uv.data.foreach_set("uv", uvs.ravel())
 
-                # Lights
-                if light_col != None and materials[Col - 1][3] > 0:
-                    light_obj = bpy.data.objects.new(name=file_name + "_" + str(Col), object_data=light_data)
-                    light_obj.location = (x + 0.5, y + 0.5, z + 0.5)  # Set location to center of voxel.
-                    light_col.objects.link(light_obj)
-                    lights.append(light_obj)
-
-                if not self.compareVox(colID, Vec3(x + 1, y, z)):
-                    verts.append((x + 1, y, z))
-                    verts.append((x + 1, y + 1, z))
-                    verts.append((x + 1, y + 1, z + 1))
-                    verts.append((x + 1, y, z + 1))
-
-                    faces.append([len(verts) - 4,
-                                  len(verts) - 3,
-                                  len(verts) - 2,
-                                  len(verts) - 1])
-
-                if not self.compareVox(colID, Vec3(x, y + 1, z)):
-                    verts.append((x + 1, y + 1, z))
-                    verts.append((x + 1, y + 1, z + 1))
-                    verts.append((x, y + 1, z + 1))
-                    verts.append((x, y + 1, z))
-
-                    faces.append([len(verts) - 4,
-                                  len(verts) - 3,
-                                  len(verts) - 2,
-                                  len(verts) - 1])
-
-                if not self.compareVox(colID, Vec3(x, y, z + 1)):
-                    verts.append((x, y, z + 1))
-                    verts.append((x, y + 1, z + 1))
-                    verts.append((x + 1, y + 1, z + 1))
-                    verts.append((x + 1, y, z + 1))
-
-                    faces.append([len(verts) - 4,
-                                  len(verts) - 3,
-                                  len(verts) - 2,
-                                  len(verts) - 1])
-
-                if not self.compareVox(colID, Vec3(x - 1, y, z)):
-                    verts.append((x, y, z))
-                    verts.append((x, y + 1, z))
-                    verts.append((x, y + 1, z + 1))
-                    verts.append((x, y, z + 1))
-
-                    faces.append([len(verts) - 4,
-                                  len(verts) - 3,
-                                  len(verts) - 2,
-                                  len(verts) - 1])
-
-                if not self.compareVox(colID, Vec3(x, y - 1, z)):
-                    verts.append((x, y, z))
-                    verts.append((x, y, z + 1))
-                    verts.append((x + 1, y, z + 1))
-                    verts.append((x + 1, y, z))
-
-                    faces.append([len(verts) - 4,
-                                  len(verts) - 3,
-                                  len(verts) - 2,
-                                  len(verts) - 1])
-
-                if not self.compareVox(colID, Vec3(x, y, z - 1)):
-                    verts.append((x, y, z))
-                    verts.append((x + 1, y, z))
-                    verts.append((x + 1, y + 1, z))
-                    verts.append((x, y + 1, z))
-
-                    faces.append([len(verts) - 4,
-                                  len(verts) - 3,
-                                  len(verts) - 2,
-                                  len(verts) - 1])
-
-            mesh.from_pydata(verts, [], faces)
-
-            if material_type == 'SepMat' or material_type == 'Recolor':
-                obj.data.materials.append(bpy.data.materials.get("#" + str(Col)))
-                # obj.data.materials.append(bpy.data.materials.get(file_name + " #" + str(Col)))
-
-            elif material_type == 'VertCol':
-                obj.data.materials.append(bpy.data.materials.get(file_name))
-
-                # Create Vertex Colors
-                bpy.context.view_layer.objects.active = obj
-                bpy.ops.mesh.vertex_color_add()  # Color
-                bpy.ops.mesh.vertex_color_add()  # Materials
-                bpy.context.object.data.vertex_colors["Col.001"].name = "Mat"
-
-                # Set Vertex Colors
-                color_layer = mesh.vertex_colors["Col"]
-                material_layer = mesh.vertex_colors["Mat"]
-
-                i = 0
-                for poly in mesh.polygons:
-                    for idx in poly.loop_indices:
-                        color_layer.data[i].color = palette[Col - 1]
-                        #                                                                                        Map emit value from [0,5] to [0,1]
-                        material_layer.data[i].color = [materials[Col - 1][0], materials[Col - 1][1],
-                                                        materials[Col - 1][2], materials[Col - 1][3] / 5]
-                        i += 1
-
-            elif material_type == 'Tex':
-                obj.data.materials.append(bpy.data.materials.get(file_name))
-
-                # Create UVs
-                uv = obj.data.uv_layers.new(name="UVMap")
-                for loop in obj.data.loops:
-                    uv.data[loop.index].uv = [(Col - 0.5) / 256, 0.5]
-
-        bpy.ops.object.select_all(action='DESELECT')
-        for obj in objects:
-            obj.select_set(True)  # Select all objects that were generated.
-
-        obj = objects[0]
-        bpy.context.view_layer.objects.active = obj  # Make the first one active.
-        bpy.ops.object.join()  # Join selected objects.
-
-        # Sets the origin of object to be the same as in MagicaVoxel so that its location can be set correctly.
-        bpy.context.scene.cursor.location = [0, 0, 0]
-        obj.location = [int(-self.size.x / 2), int(-self.size.y / 2), int(-self.size.z / 2)]
-        bpy.ops.object.origin_set(type='ORIGIN_CURSOR', center='MEDIAN')
-
-        for light in lights:
-            light.parent = obj  # Parent Lights to Object
-            x, y, z = light.location  # Fix Location
-            light.location = [x + int(-self.size.x / 2), y + int(-self.size.y / 2), z + int(-self.size.z / 2)]
-
-        # Set scale and position.
-        bpy.ops.transform.translate(
-            value=(self.position.x * vox_size, self.position.y * vox_size, self.position.z * vox_size))
-        bpy.ops.transform.resize(value=(vox_size, vox_size, vox_size))
-        obj.rotation_euler = self.rotation.as_tup()
-
-        # Cleanup Mesh
-        if cleanup:
-            bpy.ops.object.editmode_toggle()
-            bpy.ops.mesh.select_all(action='SELECT')
-            bpy.ops.mesh.remove_doubles()
-            bpy.ops.mesh.normals_make_consistent(inside=False)
-            bpy.ops.object.editmode_toggle()
+    return obj
+
+
+def add_lights(name, parent, color_positions, vox_size, palette_lut, materials, light_col):
+    """
+    Adds a point light at each given position, sharing one light datablock per color.
+    :param parent: object the lights are parented to, positions being in its local space
+    :param color_positions: {color id: (N, 3) ndarray of positions}
+    """
+    for Col, positions in color_positions.items():
+        light_data = bpy.data.lights.new(name=name + "_" + str(Col), type="POINT")
+        light_data.color = palette_lut[Col - 1][:3]
+        light_data.energy = materials[Col - 1][3] * 500 * vox_size
+        light_data.specular_factor = 0  # Don't want circular reflections.
+        light_data.shadow_soft_size = vox_size / 2
+        light_data.shadow_buffer_clip_start = vox_size
+
+        for location in positions.tolist():
+            light_obj = bpy.data.objects.new(name=name + "_" + str(Col), object_data=light_data)
+            light_obj.location = location  # Center of voxel.
+            light_obj.parent = parent
+            light_col.objects.link(light_obj)
+
+
+def generate_merged(file_name, instances, vox_size, material_type, palette_lut, material_lut, materials,
+                    model_materials, cleanup, collections):
+    """
+    Bakes the transform of every model instance into a single mesh, creating one object for the whole scene.
+    Takes the same options as VoxelObject.generate.
+    :param instances: [ModelInstance, ...]
+    """
+    mesh_col, light_col, volume_col = collections
+
+    verts = []
+    faces = []
+    face_colors = []
+    color_positions = {}
+    vert_count = 0
+
+    for instance in instances:
+        model = instance.model
+        if len(model.used_colors) == 0:  # Empty Object
+            continue
+
+        rotation = instance.matrix[:3, :3]
+        translation = instance.matrix[:3, 3]
+
+        model_verts, model_faces, model_face_colors = model.mesh_data(cleanup)
+        if np.linalg.det(rotation) < 0:  # Mirrored, flip the winding so normals still point out.
+            model_faces = model_faces[:, ::-1]
+
+        verts.append(model_verts @ rotation.T + translation)
+        faces.append(model_faces + vert_count)
+        face_colors.append(model_face_colors)
+        vert_count += len(model_verts)
+
+        if light_col != None:
+            for Col, positions in model.light_positions(materials).items():
+                color_positions.setdefault(Col, []).append(positions @ rotation.T + translation)
+
+    if not verts:
+        return
+
+    obj = create_voxel_object(file_name, np.concatenate(verts), np.concatenate(faces), np.concatenate(face_colors),
+                              material_type, palette_lut, material_lut, model_materials, mesh_col)
+
+    # Lights
+    if light_col != None:
+        color_positions = {Col: np.concatenate(positions) for Col, positions in color_positions.items()}
+        add_lights(file_name, obj, color_positions, vox_size, palette_lut, materials, light_col)
+
+    obj.scale = (vox_size, vox_size, vox_size)
 
 
 ################################################################################################################################################
 ################################################################################################################################################
 
-def read_chunk(buffer):
-    *name, h_size, h_children = struct.unpack('<4cii', buffer.read(12))
-    name = b"".join(name)
-    content = bytearray(buffer.read(h_size))
-    return name, content
+def neighbor_views(grid):
+    """
+    Views of a padded grid offset one voxel along each of the six face directions.
+    :param grid: 3D ndarray padded by one voxel on every side
+    :return: generator of (axis, step, view), view[x, y, z] being the neighbour of unpadded voxel (x, y, z)
+             one step (+1 or -1) along axis
+    """
+    inner = slice(1, -1)
+    for axis in range(3):
+        for step in (1, -1):
+            neighbor = [inner, inner, inner]
+            neighbor[axis] = slice(1 + step, grid.shape[axis] - 1 + step)
+            yield axis, step, grid[tuple(neighbor)]
+
+
+def _emit_faces_kernel(grid, out_corners, out_colors):
+    """
+    Whole greedy_mesh sweep without vertex deduplication, written for Numba to compile.
+    Each slab is merged on a mask holding the color id of every visible face, so rectangles
+    only grow over cells of their own color and match the per-color greedy_rectangles output.
+    :param grid: 3D C-contiguous uint8 ndarray of color ids, padded by one empty voxel on every side
+    :param out_corners: (4 * N, 3) int32 ndarray receiving 4 corners per quad, N at least the number of visible faces
+    :param out_colors: (N,) uint8 ndarray receiving the color id of each quad
+    :return: number of quads written
+    """
+    count = 0
+    voxel = np.zeros(3, dtype=np.int64)
+
+    for axis in range(3):
+        u_axis = (axis + 1) % 3
+        v_axis = (axis + 2) % 3
+        size_u = grid.shape[u_axis] - 2
+        size_v = grid.shape[v_axis] - 2
+        mask = np.zeros((size_u, size_v), dtype=np.uint8)
+
+        for side in range(2):
+            step = 1 - 2 * side
+
+            for layer in range(grid.shape[axis] - 2):
+                found = False
+                for u in range(size_u):
+                    for v in range(size_v):
+                        voxel[axis] = layer + 1
+                        voxel[u_axis] = u + 1
+                        voxel[v_axis] = v + 1
+                        col = grid[voxel[0], voxel[1], voxel[2]]
+                        voxel[axis] += step
+                        if col != 0 and grid[voxel[0], voxel[1], voxel[2]] == 0:
+                            mask[u, v] = col
+                            found = True
+                        else:
+                            mask[u, v] = 0
+
+                if not found:
+                    continue
+
+                plane = layer + 1 if step == 1 else layer
+
+                for u in range(size_u):
+                    v = 0
+                    while v < size_v:
+                        col = mask[u, v]
+                        if col == 0:
+                            v += 1
+                            continue
+
+                        dv = 1
+                        while v + dv < size_v and mask[u, v + dv] == col:
+                            dv += 1
+
+                        du = 1
+                        extend = True
+                        while extend and u + du < size_u:
+                            for i in range(v, v + dv):
+                                if mask[u + du, i] != col:
+                                    extend = False
+                                    break
+                            if extend:
+                                du += 1
+
+                        mask[u:u + du, v:v + dv] = 0
+
+                        # Same corner order as greedy_mesh, reversed for faces pointing down the axis.
+                        for corner in range(4):
+                            row = count * 4 + (corner if step == 1 else 3 - corner)
+                            out_corners[row, axis] = plane
+                            out_corners[row, u_axis] = u + du if corner == 1 or corner == 2 else u
+                            out_corners[row, v_axis] = v + dv if corner >= 2 else v
+                        out_colors[count] = col
+                        count += 1
+                        v += dv
+
+    return count
+
+
+EMIT_FACES_SIGNATURE = 'int64(uint8[:, :, ::1], int32[:, ::1], uint8[::1])'
+
+
+
+def kernel_version(source):
+    """
+    Fingerprint of the kernels and their signatures, built into vox_kernels by build_kernels.py
+    so a build left over from another version of the add-on isn't used.
+    :param source: source code of io_scene_vox.py
+    :return: int64 hash of every *_kernel function and *_SIGNATURE constant, ignoring formatting and comments
+    """
+    parts = []
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.FunctionDef) and node.name.endswith("_kernel"):
+            parts.append(ast.dump(node))
+        elif isinstance(node, ast.Assign) and any(target.id.endswith("_SIGNATURE") for target in node.targets
+                                                  if isinstance(target, ast.Name)):
+            parts.append(ast.dump(node))
+
+    digest = hashlib.blake2b("\n".join(parts).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+
+# Prefer the kernel compiled ahead of time by build_kernels.py, which needs neither Numba nor a compile at load.
+# Otherwise Numba compiles it when the add-on loads, caching it on disk so later sessions skip the compile.
+_emit_faces = None
+try:
+    import vox_kernels as _vox_kernels
+except ImportError:
+    _vox_kernels = None
+
+if _vox_kernels is not None:
+    with open(__file__, encoding='utf-8') as file:
+        current_version = kernel_version(file.read())
+
+    # Builds from before the version was exported don't have it.
+    if getattr(_vox_kernels, 'kernel_version', lambda: None)() == current_version:
+        _emit_faces = _vox_kernels.emit_faces
+    else:
+        print(f"Ignoring {_vox_kernels.__file__}, it was built from other kernels. Rebuild it with build_kernels.py.")
+
+if _emit_faces is None and HAS_NUMBA:
+    _emit_faces = njit(EMIT_FACES_SIGNATURE, cache=True)(_emit_faces_kernel)
+
+
+def greedy_rectangles(mask):
+    """
+    Splits a 2D boolean mask into maximal rectangles, greedily extending along V then U.
+    Each row is packed into one integer bitset (bit v set if mask[u, v]), so runs are found and
+    rows are tested and cleared a whole word at a time instead of cell by cell.
+    :param mask: 2D bool ndarray
+    :return: [(u, v, du, dv), ...]
+    """
+    rects = []
+    packed = np.packbits(mask, axis=1, bitorder='little')
+    rows = [int.from_bytes(row.tobytes(), 'little') for row in packed]
+
+    for u, row in enumerate(rows):
+        while row:
+            v = (row & -row).bit_length() - 1  # Lowest set bit.
+            shifted = row >> v
+            dv = (~shifted & (shifted + 1)).bit_length() - 1  # Trailing ones, the length of the run.
+            run = ((1 << dv) - 1) << v
+
+            # Extend along U while the next row holds the whole run.
+            du = 1
+            while u + du < len(rows) and rows[u + du] & run == run:
+                rows[u + du] &= ~run
+                du += 1
+
+            row &= ~run
+            rects.append((u, v, du, dv))
+
+    return rects
+
+
+def sweep_faces(grid):
+    """
+    NumPy greedy_mesh sweep, used when Numba isn't available.
+    :param grid: 3D uint8 ndarray of color ids, 0 being empty, padded by one empty voxel on every side
+    :return: (N, 4, 3) int32 ndarray of quad corners, (N,) uint8 ndarray of quad color ids
+    """
+    corners = [np.empty((0, 4, 3), dtype=np.int32)]
+    colors = [np.empty(0, dtype=np.uint8)]
+
+    inner = slice(1, -1)
+    grid_colors = grid[inner, inner, inner]
+    solid = grid_colors != 0
+
+    # Corners of a unit quad in (u, v), counter-clockwise seen from +axis.
+    quad_u = np.array([0, 1, 1, 0], dtype=np.int32)
+    quad_v = np.array([0, 0, 1, 1], dtype=np.int32)
+
+    for axis, step, neighbor in neighbor_views(grid == 0):
+        # (axis, u, v) is a cyclic permutation of (x, y, z), so u cross v points along +axis.
+        order = (axis, (axis + 1) % 3, (axis + 2) % 3)
+        layer_colors = np.transpose(grid_colors, order)
+        visible = np.transpose(solid & neighbor, order)
+
+        rects = []  # [(plane, u, v, du, dv, color id), ...]
+        for layer in np.flatnonzero(visible.any(axis=(1, 2))):
+            plane = layer + 1 if step == 1 else layer
+
+            for col in np.unique(layer_colors[layer][visible[layer]]):
+                for rect in greedy_rectangles(visible[layer] & (layer_colors[layer] == col)):
+                    rects.append((plane, *rect, col))
+
+        if not rects:
+            continue
+
+        # Stretch the unit quad over every rectangle of this direction at once.
+        plane, u, v, du, dv, col = np.array(rects, dtype=np.int32).T
+        face = np.empty((len(rects), 4, 3), dtype=np.int32)
+        face[:, :, order[0]] = plane[:, None]
+        face[:, :, order[1]] = u[:, None] + du[:, None] * quad_u
+        face[:, :, order[2]] = v[:, None] + dv[:, None] * quad_v
+
+        corners.append(face if step == 1 else face[:, ::-1])
+        colors.append(col.astype(np.uint8))
+
+    return np.concatenate(corners), np.concatenate(colors)
+
+
+def greedy_mesh(grid, weld=True):
+    """
+    Builds the visible surface of every color in one sweep, merging coplanar same-color faces into maximal quads.
+    Faces are hidden only when the neighbouring voxel is filled, regardless of its color.
+    Vertices are deduplicated once the quads are built, so faces sharing a corner share its index.
+    :param grid: 3D uint8 ndarray of color ids, 0 being empty, padded by one empty voxel on every side
+    :param weld: share vertices between colors too, otherwise each color gets its own
+    :return: verts (V, 3) int ndarray, faces (F, 4) int32 ndarray wound with outward normals,
+             face_colors (F,) int32 ndarray of the color id of each face
+    """
+    if _emit_faces is not None:
+        # Every visible voxel face is an upper bound on the merged quad count.
+        solid = grid[1:-1, 1:-1, 1:-1] != 0
+        max_faces = sum(np.count_nonzero(solid & neighbor) for _, _, neighbor in neighbor_views(grid == 0))
+
+        corners = np.empty((max_faces * 4, 3), dtype=np.int32)
+        colors = np.empty(max_faces, dtype=np.uint8)
+        count = _emit_faces(np.ascontiguousarray(grid, dtype=np.uint8), corners, colors)
+        corners, colors = corners[:count * 4].reshape(-1, 4, 3), colors[:count]
+    else:
+        corners, colors = sweep_faces(grid)
+
+    # Merge by distance on the integer lattice: pack each corner (and its color when not welding)
+    # into one int64 so a single 1D unique finds the duplicates.
+    points = corners.reshape(-1, 3).astype(np.int64)
+    keys = (points[:, 0] << 32) | (points[:, 1] << 16) | points[:, 2]
+    if not weld:
+        keys |= np.repeat(colors.astype(np.int64), 4) << 48
+
+    keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    verts = points[first]
+    faces = inverse.reshape(-1, 4).astype(np.int32)
+
+    return verts, faces, colors.astype(np.int32)
+
+
+def fill_mesh(mesh, verts, faces):
+    """
+    Writes quads into an empty mesh with bulk foreach_set copies rather than from_pydata.
+    :param mesh: empty bpy.types.Mesh
+    :param verts: [(x, y, z), ...]
+    :param faces: [[a, b, c, d], ...] vertex indices of each quad
+    """
+    verts = np.asarray(verts, dtype=np.float32).reshape(-1, 3)
+    faces = np.asarray(faces, dtype=np.int32).reshape(-1, 4)
+
+    mesh.vertices.add(len(verts))
+    mesh.loops.add(faces.size)
+    mesh.polygons.add(len(faces))
+
+    # Blender 3.5+ stores positions as a plain attribute, writing it directly skips the MeshVertex wrappers.
+    if "position" in mesh.attributes:
+        mesh.attributes["position"].data.foreach_set("vector", verts.ravel())
+    else:
+        mesh.vertices.foreach_set("co", verts.ravel())
+    mesh.loops.foreach_set("vertex_index", faces.ravel())
+    mesh.polygons.foreach_set("loop_start", np.arange(0, faces.size, 4, dtype=np.int32))
+    if bpy.app.version < (4, 0, 0):  # Read-only from 4.0, face sizes follow from loop_start.
+        mesh.polygons.foreach_set("loop_total", np.full(len(faces), 4, dtype=np.int32))
+
+    mesh.update(calc_edges=True)
+
+
+def surface_voxels(grid, col):
+    """
+    Finds voxels of one color that have at least one neighbour of another color or empty.
+    Voxels fully enclosed by their own color are skipped, as a light there would never be seen.
+    :param grid: 3D uint8 ndarray of color ids, 0 being empty, padded by one empty voxel on every side
+    :param col: color id to search
+    :return: (N, 3) int ndarray of unpadded voxel coordinates
+    """
+    inner = slice(1, -1)
+    same = grid == col
+    enclosed = same[inner, inner, inner].copy()
+
+    for _, _, neighbor in neighbor_views(same):
+        enclosed &= neighbor
+
+    return np.argwhere(same[inner, inner, inner] & ~enclosed)
+
+
+VOXEL_DTYPE = np.dtype((np.uint8, 4))  # x, y, z, color id, reads as one (N, 4) row per voxel
+
+
+def read_chunk(data, offset):
+    """
+    Reads the chunk header at offset without copying its content.
+    :param data: memoryview of the whole file
+    :param offset: offset of the chunk header
+    :return: name, content [data, read cursor], offset of the next chunk
+    """
+    name, h_size, h_children = struct.unpack_from('<4sii', data, offset)
+    content_offset = offset + 12
+    return name, [data, content_offset], content_offset + h_size
 
 
 def read_content(content, size):
-    out = content[:size]
-    del content[:size]
+    data, cursor = content
+    content[1] = cursor + size
 
-    return out
+    return data[cursor:cursor + size]
+
+
+def read_struct(content, fmt):
+    """
+    Unpacks fields straight from the file at the read cursor, without slicing it.
+    :param fmt: struct format string
+    :return: tuple of values
+    """
+    data, cursor = content
+    content[1] = cursor + struct.calcsize(fmt)
+
+    return struct.unpack_from(fmt, data, cursor)
+
+
+def read_array(content, dtype, count):
+    """
+    Reads count values at the read cursor as one read-only ndarray viewing the file.
+    :param dtype: numpy dtype of a value, subarray dtypes add their shape
+    :return: (count, ...) ndarray
+    """
+    data, cursor = content
+    dtype = np.dtype(dtype)
+    content[1] = cursor + dtype.itemsize * count
+
+    return np.frombuffer(data, dtype=dtype, count=count, offset=cursor)
 
 
 def read_dict(content):
     dict = {}
 
-    dict_size, = struct.unpack('<i', read_content(content, 4))
+    dict_size, = read_struct(content, '<i')
     for _ in range(dict_size):
-        key_bytes, = struct.unpack('<i', read_content(content, 4))
-        key = struct.unpack('<' + str(key_bytes) + 'c', read_content(content, key_bytes))
-        key = b"".join(key)
+        key_bytes, = read_struct(content, '<i')
+        key = bytes(read_content(content, key_bytes))
 
-        value_bytes, = struct.unpack('<i', read_content(content, 4))
-        value = struct.unpack('<' + str(value_bytes) + 'c', read_content(content, value_bytes))
-        value = b"".join(value)
+        value_bytes, = read_struct(content, '<i')
+        value = bytes(read_content(content, value_bytes))
 
         dict[key] = value
 
     return dict
 
 
-def solve_scene_graph(transforms, groups, shapes, models):
+class SceneGraph:
+    """
+    Scene graph nodes stored as parallel arrays indexed by node id, grown as ids are seen.
+    """
+    TRANSFORM, GROUP, SHAPE = 1, 2, 3  # Node kinds, 0 for ids not in the file
+
+    def __init__(self, capacity=64):
+        self.kind = np.zeros(capacity, dtype=np.int8)
+        self.parent = np.full(capacity, -1, dtype=np.int32)  # -1 for the root and unreferenced nodes
+        self.local = np.tile(np.eye(4, dtype=np.float32), (capacity, 1, 1))  # Identity for groups and shapes
+        self.models = {}  # {shape node id: [model ids]}
+
+    def reserve(self, node_id):
+        capacity = len(self.kind)
+        if node_id < capacity:
+            return
+
+        grow = max(capacity, node_id + 1 - capacity)
+        self.kind = np.concatenate([self.kind, np.zeros(grow, dtype=np.int8)])
+        self.parent = np.concatenate([self.parent, np.full(grow, -1, dtype=np.int32)])
+        self.local = np.concatenate([self.local, np.tile(np.eye(4, dtype=np.float32), (grow, 1, 1))])
+
+    def add_transform(self, node_id, child_id, translation, rotation):
+        """
+        :param translation: (x, y, z) in voxels
+        :param rotation: 3x3 rotation matrix
+        """
+        self.reserve(max(node_id, child_id))
+        self.kind[node_id] = SceneGraph.TRANSFORM
+        self.local[node_id, :3, :3] = rotation
+        self.local[node_id, :3, 3] = translation
+        self.parent[child_id] = node_id
+
+    def add_group(self, node_id, child_ids):
+        """
+        :param child_ids: int32 ndarray of child node ids
+        """
+        self.reserve(max(node_id, child_ids.max(initial=0)))
+        self.kind[node_id] = SceneGraph.GROUP
+        self.parent[child_ids] = node_id
+
+    def add_shape(self, node_id, model_ids):
+        self.reserve(node_id)
+        self.kind[node_id] = SceneGraph.SHAPE
+        self.models[node_id] = model_ids
+
+
+def solve_scene_graph(graph, models):
     """
     Applies transformations to generated models
-    :param transforms: {int node_id: [child_id, Vec3 transform, Vec3 rotation], ...}
-    :param groups: {int node_id: [int child_id, ...], ...}
-    :param shapes: {int node_id: [int model_id (not a node)], ...}
-    :return: models with correct transforms applied.
+    :param graph: SceneGraph
+    :param models: {int model_id: VoxelObject}
+    :return: [ModelInstance, ...] one per shape model reached from the root, in node id order.
     """
 
-    if 0 not in transforms.keys():
+    if graph.kind[0] != SceneGraph.TRANSFORM:
         raise ValueError(
-            f"Root (id: 0) not found in transform nodes {list(transforms.keys())}. This probably means an assumption about tree structure is incorrect.")
+            f"Root (id: 0) not found in transform nodes {np.flatnonzero(graph.kind == SceneGraph.TRANSFORM).tolist()}. This probably means an assumption about tree structure is incorrect.")
+
+    # Walk every node up to its root together, counting the steps to get its depth.
+    depth = np.zeros(len(graph.kind), dtype=np.int32)
+    root = np.arange(len(graph.kind), dtype=np.int32)
+    ancestor = graph.parent.copy()
+    while True:
+        climbing = np.flatnonzero(ancestor >= 0)
+        if len(climbing) == 0:
+            break
+        if depth.max() >= len(depth):
+            raise ValueError("Cycle found in the scene graph.")
+
+        depth[climbing] += 1
+        root[climbing] = ancestor[climbing]
+        ancestor[climbing] = graph.parent[ancestor[climbing]]
+
+    # Parents are a level above their children, so each level is one batched matmul
+    # giving every node the product of every transform above it.
+    world = graph.local.copy()
+    for level in range(1, depth.max() + 1):
+        nodes = np.flatnonzero(depth == level)
+        world[nodes] = world[graph.parent[nodes]] @ world[nodes]
+
     transformed_models = []
+    for node_id in sorted(graph.models):
+        if root[node_id] != 0:  # Not part of the scene.
+            continue
+        for model_id in graph.models[node_id]:
+            transformed_models.append(ModelInstance(models[model_id], world[node_id]))
 
-    def traverse_scene_graph(current_location, current_rotation, current_id):
-        if current_id in transforms.keys():
-            new_location = transforms[current_id][1]
-            current_location = Vec3(
-                current_location.x + new_location.x,
-                current_location.y + new_location.y,
-                current_location.z + new_location.z
-            )
-            new_rotation = transforms[current_id][2]
-            current_rotation = [sum(pair) for pair in zip(new_rotation, current_rotation)]
-            traverse_scene_graph(current_location, current_rotation, transforms[current_id][0])
-        elif current_id in groups.keys():
-            for child_id in groups[current_id]:
-                traverse_scene_graph(current_location, current_rotation, child_id)
-        elif current_id in shapes.keys():
-            for model_id in shapes[current_id]:
-                model = copy.deepcopy(models[model_id])
-                model.rotation = Vec3(*current_rotation)
-                model.position = current_location
-                transformed_models.append(model)
-
-    traverse_scene_graph(current_location=Vec3(0, 0, 0), current_rotation=[0, 0, 0], current_id=0)
-    # for transform_node in transforms.values():
-    #     trans_child_id = transform_node[0]
-    #     translation = transform_node[1]
-    #     rotation = transform_node[2]
-    #
-    #     if trans_child_id in groups:
-    #         group_children = groups[trans_child_id]
-    #         print(f"Group children IDs: {group_children}")
-    #         # In my testing, group nodes never have valid
-    #         # children ids. Is the documentation correct?
-    #
-    #     if trans_child_id in shapes:
-    #         shape_children = shapes[trans_child_id]
-    #
-    #         for model_id in shape_children:
-    #             model = copy.deepcopy(models[model_id])
-    #             model.position = translation
-    #             transformed_models.append(model)
     return transformed_models
 
 
 def parse_rotation_matrix(byte):
     """
     Parse the Magicavoxel byte -> rotation matrix format
-    :param byte: object that can be cast to int, less than  bits
+    Bits 0-1 and 2-3 give the column of the non-zero entry in rows 0 and 1, bits 4-6 the sign of each row.
+    :param byte: object that can be cast to int, less than 8 bits
     :return: 3x3 rotation matrix
     """
+    byte = int(byte)
+    first_row_coord = byte & 3
+    second_row_coord = (byte >> 2) & 3
+    third_row_coord = 3 - first_row_coord - second_row_coord
+
     rotation_matrix = [
         [0, 0, 0],
         [0, 0, 0],
         [0, 0, 0]
     ]
-    open_rows = [0, 1, 2]
-    # Chop off '0b' and pad to 8 bits
-    byte_string = bin(int(byte))[2:].zfill(8)
-    first_row_coord = int(byte_string[-2:], 2)
-    second_row_coord = int(byte_string[-4:-2], 2)
-    open_rows.remove(first_row_coord)
-    open_rows.remove(second_row_coord)
-    third_row_coord = open_rows[0]
-    if byte_string[-5] == '1':
-        rotation_matrix[0][first_row_coord] = -1
-    else:
-        rotation_matrix[0][first_row_coord] = 1
-    if byte_string[-6] == '1':
-        rotation_matrix[1][second_row_coord] = -1
-    else:
-        rotation_matrix[1][second_row_coord] = 1
-    if byte_string[-7] == '1':
-        rotation_matrix[2][third_row_coord] = -1
-    else:
-        rotation_matrix[2][third_row_coord] = 1
+    rotation_matrix[0][first_row_coord] = -1 if byte & 0x10 else 1
+    rotation_matrix[1][second_row_coord] = -1 if byte & 0x20 else 1
+    rotation_matrix[2][third_row_coord] = -1 if byte & 0x40 else 1
     return rotation_matrix
 
 
-def rotation_to_euler(matrix):
+VOX_SHADER_GROUP = "_VOX_Shader"
+
+
+def get_vox_shader_group():
     """
-    Converts a rotation matrix to euler rotation radians
-    For math, refer to https://stackoverflow.com/questions/15022630/how-to-calculate-the-angle-from-rotation-matrix
-    :param matrix: [3x3 rotational matrix]
-    :return: [float, float, float] rotation euler radians
+    Gets the node group turning color and material data into a BSDF, building it on first use.
+    Shared by every VertCol and Tex material, which only differ in where that data is read from.
+    :return: bpy.types.ShaderNodeTree with inputs Color, Material, Material Alpha and output BSDF
     """
-    x = math.atan2(matrix[2][1], matrix[2][2])
-    y = math.atan2(-1 * matrix[2][0], math.sqrt((matrix[2][1] ** 2) + (matrix[2][2] ** 2)))
-    z = math.atan2(matrix[1][0], matrix[0][0])
-    return x, y, z
+    group = bpy.data.node_groups.get(VOX_SHADER_GROUP)
+    if group is not None:
+        return group
+
+    group = bpy.data.node_groups.new(VOX_SHADER_GROUP, 'ShaderNodeTree')
+    sockets = (('INPUT', 'NodeSocketColor', "Color"),
+               ('INPUT', 'NodeSocketColor', "Material"),
+               ('INPUT', 'NodeSocketFloat', "Material Alpha"),
+               ('OUTPUT', 'NodeSocketShader', "BSDF"))
+    for in_out, socket_type, socket_name in sockets:
+        if hasattr(group, "interface"):  # Blender 4.0+
+            group.interface.new_socket(socket_name, in_out=in_out, socket_type=socket_type)
+        elif in_out == 'INPUT':
+            group.inputs.new(socket_type, socket_name)
+        else:
+            group.outputs.new(socket_type, socket_name)
 
+    nodes = group.nodes
+    links = group.links
 
-def import_vox(path, options):
-    models = {}  # {model id : VoxelObject}
-    mod_id = 0
-    transforms = {}  # Transform Node {child id : [location, rotation]}
-    groups = {}  # Group Node {id : [children ids]}
-    shapes = {}  # Shape Node {id : [model ids]}
+    group_in = nodes.new("NodeGroupInput")
+    group_out = nodes.new("NodeGroupOutput")
+    bsdf = nodes.new("ShaderNodeBsdfPrincipled")
 
-    with open(path, 'rb') as file:
-        file_name = os.path.basename(file.name).replace('.vox', '')
-        file_size = os.path.getsize(path)
+    sepRGB = nodes.new("ShaderNodeSeparateRGB")
+    multiply = nodes.new("ShaderNodeMath")
+    multiply.operation = "MULTIPLY"
+    multiply.inputs[1].default_value = 100
+
+    links.new(group_in.outputs["Color"], bsdf.inputs["Base Color"])
+    links.new(group_in.outputs["Material"], sepRGB.inputs["Image"])
+    links.new(sepRGB.outputs["R"], bsdf.inputs["Roughness"])
+    links.new(sepRGB.outputs["G"], bsdf.inputs["Metallic"])
+    links.new(sepRGB.outputs["B"], bsdf.inputs["Transmission"])
+    links.new(group_in.outputs["Color"], bsdf.inputs["Emission"])
+    links.new(group_in.outputs["Material Alpha"], multiply.inputs[0])
+    # links.new(multiply.outputs[0], bsdf.inputs["Emission Strength"])
+    links.new(bsdf.outputs["BSDF"], group_out.inputs["BSDF"])
+
+    return group
+
+
+def link_vox_shader(mat, color_node, material_node):
+    """
+    Replaces the default BSDF of a material with the shared VOX shader group.
+    :param mat: material using nodes
+    :param color_node: node whose Color output holds the palette color
+    :param material_node: node whose Color and Alpha outputs hold the material data
+    """
+    nodes = mat.node_tree.nodes
+    links = mat.node_tree.links
+
+    nodes.remove(nodes["Principled BSDF"])
+    shader = nodes.new("ShaderNodeGroup")
+    shader.node_tree = get_vox_shader_group()
+
+    links.new(color_node.outputs["Color"], shader.inputs["Color"])
+    links.new(material_node.outputs["Color"], shader.inputs["Material"])
+    links.new(material_node.outputs["Alpha"], shader.inputs["Material Alpha"])
+    links.new(shader.outputs["BSDF"], nodes["Material Output"].inputs["Surface"])
+
+
+class VoxContext:
+    """
+    What the chunk readers have parsed so far from one file.
+    """
+    __slots__ = ('size', 'models', 'graph', 'palette', 'materials')
 
-        palette = []
+    def __init__(self):
+        self.size = None  # Vec3 from the last SIZE chunk, used by the XYZI chunk after it
+        self.models = {}  # {model id : VoxelObject}
+        self.graph = SceneGraph()  # Transform, group and shape nodes
+        self.palette = []
         # [roughness, metallic, glass, emission, specular, flux] * 255
-        materials = [[0.5, 0.0, 0.0, 0.0, 0.0, 0.0] for _ in range(255)]
+        self.materials = [[0.5, 0.0, 0.0, 0.0, 0.0, 0.0] for _ in range(255)]
 
-        # Makes sure it's supported vox file
-        assert (struct.unpack('<4ci', file.read(8)) == (b'V', b'O', b'X', b' ', 150))
 
-        # MAIN chunk
-        assert (struct.unpack('<4c', file.read(4)) == (b'M', b'A', b'I', b'N'))
-        N, M = struct.unpack('<ii', file.read(8))
-        assert (N == 0)
+def _read_size(content, context):  # Size of object.
+    x, y, z = read_struct(content, '<3i')
+    context.size = Vec3(x, y, z)
 
-        ### Parse File ###
-        while file.tell() < file_size:
-            name, content = read_chunk(file)
 
-            if name == b'SIZE':  # Size of object.
-                x, y, z = struct.unpack('<3i', read_content(content, 12))
-                size = Vec3(x, y, z)
+def _read_xyzi(content, context):  # Location and color id of voxel.
+    num_voxels, = read_struct(content, '<i')
+    # One row of (x, y, z, color id) per voxel.
+    voxels = read_array(content, VOXEL_DTYPE, num_voxels)
 
-            elif name == b'XYZI':  # Location and color id of voxel.
-                voxels = []
+    context.models[len(context.models)] = VoxelObject(voxels, context.size)
 
-                num_voxels, = struct.unpack('<i', read_content(content, 4))
-                for voxel in range(num_voxels):
-                    voxel_data = struct.unpack('<4B', read_content(content, 4))
-                    voxels.append(voxel_data)
 
-                # print(voxels)
-                model = VoxelObject(voxels, size)
-                models[mod_id] = model
-                mod_id += 1
+def _read_ntrn(content, context):  # Position and rotation of object.
+    id, = read_struct(content, '<i')
 
+    # Don't need node attributes.
+    _ = read_dict(content)
 
-            elif name == b'nTRN':  # Position and rotation of object.
-                id, = struct.unpack('<i', read_content(content, 4))
+    child_id, _, _, _, = read_struct(content, '<4i')
+    translation = (0, 0, 0)
+    rotation = [[1, 0, 0], [0, 1, 0], [0, 0, 1]]
 
-                # Don't need node attributes.
-                _ = read_dict(content)
+    frames = read_dict(content)
+    for key in frames:
+        if key == b'_r':  # Rotation
+            byte = frames[key]
+            rotation = parse_rotation_matrix(byte)
+        elif key == b'_t':  # Translation
+            value = frames[key].decode('utf-8').split()
+            translation = (int(value[0]), int(value[1]), int(value[2]))
 
-                child_id, _, _, _, = struct.unpack('<4i', read_content(content, 16))
-                transforms[id] = [child_id, Vec3(0, 0, 0), [0, 0, 0]]
+    context.graph.add_transform(id, child_id, translation, rotation)
 
-                frames = read_dict(content)
-                for key in frames:
-                    if key == b'_r':  # Rotation
-                        byte = frames[key]
-                        euler = rotation_to_euler(parse_rotation_matrix(byte))
-                        transforms[id][2] = euler
-                    elif key == b'_t':  # Translation
-                        value = frames[key].decode('utf-8').split()
-                        transforms[id][1] = Vec3(int(value[0]), int(value[1]), int(value[2]))
 
-            elif name == b'nGRP':
-                id, = struct.unpack('<i', read_content(content, 4))
+def _read_ngrp(content, context):
+    id, = read_struct(content, '<i')
 
-                # Don't need node attributes.
-                _ = read_dict(content)
+    # Don't need node attributes.
+    _ = read_dict(content)
 
-                num_child, = struct.unpack('<i', read_content(content, 4))
-                children = []
+    num_child, = read_struct(content, '<i')
+    context.graph.add_group(id, read_array(content, '<i4', num_child))
 
-                for _ in range(num_child):
-                    children.append(struct.unpack('<i', read_content(content, 4))[0])
 
-                groups[id] = children
+def _read_nshp(content, context):
+    id, = read_struct(content, '<i')
 
-            elif name == b'nSHP':
-                id, = struct.unpack('<i', read_content(content, 4))
+    # Don't need node attributes.
+    _ = read_dict(content)
 
-                # Don't need node attributes.
-                _ = read_dict(content)
+    num_models, = read_struct(content, '<i')
+    model_ids = []
 
-                num_models, = struct.unpack('<i', read_content(content, 4))
-                model_ids = []
+    for _ in range(num_models):
+        model_ids.append(read_struct(content, '<i')[0])
+        _ = read_dict(content)  # Don't need model attributes.
 
-                for _ in range(num_models):
-                    model_ids.append(struct.unpack('<i', read_content(content, 4))[0])
-                    _ = read_dict(content)  # Don't need model attributes.
+    context.graph.add_shape(id, model_ids)
 
-                shapes[id] = model_ids
 
-            elif name == b'RGBA':
-                for _ in range(255):
-                    rgba = struct.unpack('<4B', read_content(content, 4))
-                    colors = [float(col) / 255 for col in rgba]
-                    palette.append(colors)
-                del content[:4]  # Contains a 256th color for some reason.
+def _read_rgba(content, context):
+    rgba = read_array(content, np.uint8, 4 * 255).reshape(255, 4)
+    context.palette = rgba.astype(np.float32) * (1 / 255)
+    # Contains a 256th color for some reason, left unread.
 
-            elif name == b'MATL':
-                id, = struct.unpack('<i', read_content(content, 4))
-                if id > 255: continue  # Why are there material values for id 256?
 
-                mat_dict = read_dict(content)
-                mat_type = b'_diffuse'
-                unknown_keys = []
+def _read_matl(content, context):
+    id, = read_struct(content, '<i')
+    if id > 255: return  # Why are there material values for id 256?
 
-                for key in mat_dict:
-                    value = mat_dict[key]
+    materials = context.materials
+    mat_dict = read_dict(content)
+    mat_type = b'_diffuse'
+    unknown_keys = []
 
-                    mat = materials[id - 1]
+    for key in mat_dict:
+        value = mat_dict[key]
 
-                    if key == b'_type':
-                        mat_type = value
+        mat = materials[id - 1]
 
-                    if key == b'_rough':
-                        materials[id - 1][0] = float(value)  # Roughness
-                    elif key == b'_metal':
-                        if mat_type == b'_metal':
-                            materials[id - 1][1] = float(value)  # Metalic
-                        else:
-                            pass
-                    elif key == b'_alpha' and mat_type == b'_glass':
-                        materials[id - 1][2] = float(value)  # Glass
-                    elif key == b'_emit' and mat_type == b'_emit':
-                        materials[id - 1][3] = float(value)  # Emission
-                        materials[id - 1][5] = float(1.0)  # Base flux
-                    elif key == b'_flux':
-                        materials[id - 1][5] = float(value)  # Flux Power
-                    elif key == b'_sp':
-                        # In Blender BSDF specular goes 0-1 but magicavoxel it goes 1-2
-                        materials[id - 1][4] = float(value) - 1  # Specular
-                    elif key == b'_d' or key == b'_ior':
-                        pass  # diffuse or ior
-                    else:
-                        unknown_keys.append(str(key))
-                if unknown_keys:
-                    pass
-                    # print(f"#{id - 1}: Unknown keys: {unknown_keys}")
+        if key == b'_type':
+            mat_type = value
+
+        if key == b'_rough':
+            materials[id - 1][0] = float(value)  # Roughness
+        elif key == b'_metal':
+            if mat_type == b'_metal':
+                materials[id - 1][1] = float(value)  # Metalic
+            else:
+                pass
+        elif key == b'_alpha' and mat_type == b'_glass':
+            materials[id - 1][2] = float(value)  # Glass
+        elif key == b'_emit' and mat_type == b'_emit':
+            materials[id - 1][3] = float(value)  # Emission
+            materials[id - 1][5] = float(1.0)  # Base flux
+        elif key == b'_flux':
+            materials[id - 1][5] = float(value)  # Flux Power
+        elif key == b'_sp':
+            # In Blender BSDF specular goes 0-1 but magicavoxel it goes 1-2
+            materials[id - 1][4] = float(value) - 1  # Specular
+        elif key == b'_d' or key == b'_ior':
+            pass  # diffuse or ior
+        else:
+            unknown_keys.append(str(key))
+    if unknown_keys:
+        pass
+        # print(f"#{id - 1}: Unknown keys: {unknown_keys}")
+
+
+# {chunk id: reader(content, context)}, one lookup per chunk instead of a comparison per known id.
+_DISPATCH = {
+    b'SIZE': _read_size,
+    b'XYZI': _read_xyzi,
+    b'nTRN': _read_ntrn,
+    b'nGRP': _read_ngrp,
+    b'nSHP': _read_nshp,
+    b'RGBA': _read_rgba,
+    b'MATL': _read_matl,
+}
+
+VOX_PALETTE_KEY = "vox_palette"  # Custom property holding the palette hash a Tex material was built from
+
+
+def import_vox(path, options):
+    context = VoxContext()
+
+    with open(path, 'rb') as file:
+        file_name = os.path.basename(file.name).replace('.vox', '')
+        # Parsed in place from the mapping, which is unmapped once the last view of it is dropped.
+        data = memoryview(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+        # Makes sure it's supported vox file
+        assert (struct.unpack_from('<4si', data, 0) == (b'VOX ', 150))
+
+        # MAIN chunk
+        name, N, M = struct.unpack_from('<4sii', data, 8)
+        assert (name == b'MAIN')
+        assert (N == 0)
+        offset = 20
+
+        ### Parse File ###
+        while offset < len(data):
+            name, content, offset = read_chunk(data, offset)
+
+            handler = _DISPATCH.get(name)
+            if handler is not None:  # Chunks without a reader are skipped.
+                handler(content, context)
+
+    models = context.models
+    graph = context.graph
+    palette = context.palette
+    materials = context.materials
+
+    ### Lookup Tables ###
+    # Indexed by color id - 1, shared by the texture and vertex color paths.
+    palette_lut = np.asarray(palette, dtype=np.float32).reshape(-1, 4)
+    material_lut = np.asarray(materials, dtype=np.float32)[:, :4]
+    material_lut[:, 3] *= 0.2  # Map emit value from [0,5] to [0,1]
 
     ### Import Options ###
 
@@ -639,9 +1088,10 @@ def import_vox(path, options):
         gamma_value = 1
 
     if options.material_type == 'SepMat' or options.material_type == 'Recolor':  # Create material for every palette color.
-        for id, col in enumerate(palette):
+        gamma_palette = palette_lut.copy()
+        gamma_palette[:, :3] **= gamma_value
 
-            col = (pow(col[0], gamma_value), pow(col[1], gamma_value), pow(col[2], gamma_value), col[3])
+        for id, col in enumerate(gamma_palette.tolist()):
 
             name = "#" + str(id + 1)
             # name = file_name + " #" + str(id + 1)
@@ -649,9 +1099,10 @@ def import_vox(path, options):
             if name in bpy.data.materials and options.override_materials:
                 # bpy.data.materials.remove(bpy.data.materials[name])
                 mat = bpy.data.materials[name]
-                mat.node_tree.nodes.remove(mat.node_tree.nodes['Principled BSDF'])
-                new_bsdf = mat.node_tree.nodes.new('ShaderNodeBsdfPrincipled')
-                output = mat.node_tree.nodes['Material Output']
+                nodes = mat.node_tree.nodes
+                nodes.remove(nodes['Principled BSDF'])
+                new_bsdf = nodes.new('ShaderNodeBsdfPrincipled')
+                output = nodes['Material Output']
                 mat.node_tree.links.new(new_bsdf.outputs["BSDF"], output.inputs["Surface"])
             else:
                 mat = bpy.data.materials.new(name=name)
@@ -666,23 +1117,25 @@ def import_vox(path, options):
             nodes = mat.node_tree.nodes
 
             bsdf = nodes["Principled BSDF"]
-            bsdf.inputs["Base Color"].default_value = col
+            inputs = bsdf.inputs  # Socket lookups by name are linear searches, resolve the collection once.
+            mat_values = materials[id]
+            inputs["Base Color"].default_value = col
 
-            if materials[id][1] != 0.0:
+            if mat_values[1] != 0.0:
                 # 0 metallic in magicavoxel looks like 0.5 metallic in blender, but 1.0 looks the same for both
-                # bsdf.inputs["Metallic"].default_value = 0.5 + (0.5 * materials[id][1])
-                bsdf.inputs["Metallic"].default_value = math.log10(1 + (9 * materials[id][1]))
-            if materials[id][2] != 0.0:
-                print("Transmissive material[%s] dump: %s" % (id, materials[id]))
+                # inputs["Metallic"].default_value = 0.5 + (0.5 * mat_values[1])
+                inputs["Metallic"].default_value = math.log10(1 + (9 * mat_values[1]))
+            if mat_values[2] != 0.0:
+                print("Transmissive material[%s] dump: %s" % (id, mat_values))
                 print("Warning: Transmissive materials not yet supported.")
-            if materials[id][3] != 0.0:
-                bsdf.inputs["Emission"].default_value = col
+            if mat_values[3] != 0.0:
+                inputs["Emission"].default_value = col
                 # map Magicavoxel flux = [0-4] to Blender flux = [1, 21]
-                bsdf.inputs["Emission Strength"].default_value = materials[id][5] * 2
+                inputs["Emission Strength"].default_value = mat_values[5] * 2
 
-            bsdf.inputs["Roughness"].default_value = materials[id][0]
-            bsdf.inputs["Transmission"].default_value = materials[id][2]
-            bsdf.inputs["Specular"].default_value = materials[id][4]
+            inputs["Roughness"].default_value = mat_values[0]
+            inputs["Transmission"].default_value = mat_values[2]
+            inputs["Specular"].default_value = mat_values[4]
 
     elif options.material_type == 'VertCol':  # Create one material that uses vertex colors.
         name = file_name
@@ -700,43 +1153,42 @@ def import_vox(path, options):
             mat = bpy.data.materials.new(name=name)
             mat.use_nodes = True
 
-            nodes = mat.node_tree.nodes
-            links = mat.node_tree.links
-
-            bsdf = nodes["Principled BSDF"]
-
-            vc_color = nodes.new("ShaderNodeVertexColor")
+            vc_color = mat.node_tree.nodes.new("ShaderNodeVertexColor")
             vc_color.layer_name = "Col"
-            vc_mat = nodes.new("ShaderNodeVertexColor")
+            vc_mat = mat.node_tree.nodes.new("ShaderNodeVertexColor")
             vc_mat.layer_name = "Mat"
 
-            sepRGB = nodes.new("ShaderNodeSeparateRGB")
-            multiply = nodes.new("ShaderNodeMath")
-            multiply.operation = "MULTIPLY"
-            multiply.inputs[1].default_value = 100
-
-            links.new(vc_color.outputs["Color"], bsdf.inputs["Base Color"])
-            links.new(vc_mat.outputs["Color"], sepRGB.inputs["Image"])
-            links.new(sepRGB.outputs["R"], bsdf.inputs["Roughness"])
-            links.new(sepRGB.outputs["G"], bsdf.inputs["Metallic"])
-            links.new(sepRGB.outputs["B"], bsdf.inputs["Transmission"])
-            links.new(vc_color.outputs["Color"], bsdf.inputs["Emission"])
-            links.new(vc_mat.outputs["Alpha"], multiply.inputs[0])
-            # links.new(multiply.outputs[0], bsdf.inputs["Emission Strength"])
+            link_vox_shader(mat, vc_color, vc_mat)
 
     elif options.material_type == 'Tex':  # Generates textures to store color and material data.
         name = file_name
         create_mat = True
 
-        if name in bpy.data.materials:  # Material already exists.
-            if options.override_materials:
-                # Delete material + texture and recreate it.
-                bpy.data.materials.remove(bpy.data.materials[name])
-                bpy.data.images.remove(bpy.data.images[name + '_col'])
-                bpy.data.images.remove(bpy.data.images[name + '_mat'])
-            else:
+        # Files with the same palette, like MagicaVoxel's default one, can use the same textures.
+        # Materials are found by the palette hash they are tagged with, which is saved with the .blend.
+        palette_key = hashlib.blake2b(palette_lut.tobytes() + material_lut.tobytes(), digest_size=16).hexdigest()
+        shared_mat = None
+        if options.share_materials:
+            shared_mat = next((mat for mat in bpy.data.materials if mat.get(VOX_PALETTE_KEY) == palette_key), None)
+
+        if shared_mat is not None:
+            name = shared_mat.name
+            create_mat = False
+        elif name in bpy.data.materials:  # Material already exists.
+            existing_mat = bpy.data.materials[name]
+
+            if not options.override_materials:
                 # Don't change materials.
                 create_mat = False
+            elif existing_mat.get(VOX_PALETTE_KEY) is not None and existing_mat.users > 0:
+                # Objects of other files may share it, recreated under a new name instead.
+                pass
+            else:
+                # Delete material + texture and recreate it.
+                bpy.data.materials.remove(existing_mat)
+                for image_name in (name + '_col', name + '_mat'):
+                    if image_name in bpy.data.images:
+                        bpy.data.images.remove(bpy.data.images[image_name])
 
         if create_mat:
             ## Generate Texture
@@ -744,54 +1196,43 @@ def import_vox(path, options):
             col_img = bpy.data.images.new(name + '_col', width=256, height=1)
             mat_img = bpy.data.images.new(name + '_mat', width=256, height=1)
             mat_img.colorspace_settings.name = 'Non-Color'
-            col_pixels = []
-            mat_pixels = []
-
-            for i in range(255):
-                col = palette[i]
-                mat = materials[i]
-
-                col_pixels += col
-                #                                  Map emit value from [0,5] to [0,1]
-                mat_pixels += [mat[0], mat[1], mat[2], mat[3] / 5]
-
-            col_pixels += [0, 0, 0, 0]
-            mat_pixels += [0, 0, 0, 0]
+            # Both images filled from one buffer, each row a contiguous view. 256th pixel left as 0, 0, 0, 0.
+            pixels = np.zeros((2, 256, 4), dtype=np.float32)
+            pixels[0, :255] = palette_lut
+            pixels[1, :255] = material_lut
 
-            col_img.pixels = col_pixels
-            mat_img.pixels = mat_pixels
+            col_img.pixels.foreach_set(pixels[0].ravel())
+            mat_img.pixels.foreach_set(pixels[1].ravel())
 
             ## Create Material
 
             mat = bpy.data.materials.new(name=name)
             mat.use_nodes = True
 
-            nodes = mat.node_tree.nodes
-            links = mat.node_tree.links
-
-            bsdf = nodes["Principled BSDF"]
-
-            col_tex = nodes.new("ShaderNodeTexImage")
+            col_tex = mat.node_tree.nodes.new("ShaderNodeTexImage")
             col_tex.image = col_img
-            mat_tex = nodes.new("ShaderNodeTexImage")
+            mat_tex = mat.node_tree.nodes.new("ShaderNodeTexImage")
             mat_tex.image = mat_img
 
-            sepRGB = nodes.new("ShaderNodeSeparateRGB")
-            multiply = nodes.new("ShaderNodeMath")
-            multiply.operation = "MULTIPLY"
-            multiply.inputs[1].default_value = 100
+            link_vox_shader(mat, col_tex, mat_tex)
 
-            links.new(col_tex.outputs["Color"], bsdf.inputs["Base Color"])
-            links.new(mat_tex.outputs["Color"], sepRGB.inputs["Image"])
-            links.new(sepRGB.outputs["R"], bsdf.inputs["Roughness"])
-            links.new(sepRGB.outputs["G"], bsdf.inputs["Metallic"])
-            links.new(sepRGB.outputs["B"], bsdf.inputs["Transmission"])
-            links.new(col_tex.outputs["Color"], bsdf.inputs["Emission"])
-            links.new(mat_tex.outputs["Alpha"], multiply.inputs[0])
-            # links.new(multiply.outputs[0], bsdf.inputs["Emission Strength"])
+            mat[VOX_PALETTE_KEY] = palette_key
+            name = mat.name  # Gets a suffix if the name is still taken.
 
     ### Apply Transforms ##
-    transformed_models = solve_scene_graph(transforms, groups, shapes, models)
+    transformed_models = solve_scene_graph(graph, models)
+
+    ## Look Up Materials ##
+    # Once per import rather than once per color of every model instance.
+    if options.material_type == 'SepMat' or options.material_type == 'Recolor':
+        used_colors = set()
+        for model in models.values():
+            used_colors.update(model.used_colors)
+        model_materials = {Col: bpy.data.materials.get("#" + str(Col)) for Col in used_colors}
+    elif options.material_type == 'VertCol' or options.material_type == 'Tex':
+        model_materials = dict.fromkeys(range(1, 256), bpy.data.materials.get(name))  # Shared by every color.
+    else:
+        model_materials = {}
 
     ## Create Collections ##
     collections = (None, None, None)
@@ -817,9 +1258,14 @@ def import_vox(path, options):
         collections = (mesh_col, light_col, volume_col)
 
     ### Generate Objects ###
-    for model in transformed_models:
-        model.generate(file_name, options.voxel_size, options.material_type, palette, materials, options.cleanup_mesh,
-                       collections)
+    if options.merge_models:
+        generate_merged(file_name, transformed_models, options.voxel_size, options.material_type, palette_lut,
+                        material_lut, materials, model_materials, options.cleanup_mesh, collections)
+    else:
+        for instance in transformed_models:
+            instance.model.generate(file_name, instance.matrix, options.voxel_size,
+                                    options.material_type, palette_lut, material_lut, materials, model_materials,
+                                    options.cleanup_mesh, collections)
 
 
 ################################################################################################################################################